@@ -0,0 +1,67 @@
+"""
+fact_tables.py
+
+A python script that maintains a daily fact table comparing Google Analytics traffic with Twitter campaign metrics.
+
+Each row is the page views of a normalized URL on a day, joined with the total metrics of the Twitter campaigns
+on that day. The table is written to Parquet with one Day=<yyyy-mm-dd> directory per day, so filters on Day only
+read the matching days. The scheduler refreshes the days of each shard it collects.
+"""
+from deephaven import agg, merge
+from deephaven.parquet import read, write
+from deephaven.time import plus_nanos
+
+import os
+
+FACT_PATH = "/data/facts/ga_twitter_daily/"
+ONE_DAY_NANOS = 86400000000000
+CLEAN_URL_FORMULA = "URL = URL.contains(`query_params`) ? URL.substring(0, URL.length() - 12) : URL"
+
+def build_ga_twitter_daily(ga_table, twitter_table):
+    """
+    Builds the daily fact table from Google Analytics and Twitter tables
+
+    Parameters:
+        ga_table (Table): A Google Analytics table created by GaCollector
+        twitter_table (Table): A Twitter table created by TwitterCollector.twitter_analytics_data
+    Returns:
+        Table: The fact table, with a Day column containing the yyyy-mm-dd date
+    """
+    ga_daily = ga_table.update(CLEAN_URL_FORMULA)\
+        .agg_by([agg.sum_(["PageViews"])], by=["Date", "URL"])
+    twitter_daily = twitter_table.where("AnalyticsType == `Campaign`")\
+        .agg_by([agg.sum_(["CampaignImpressions = Impressions", "CampaignClicks = Clicks", "CampaignEngagements = Engagements"])], by=["Date"])
+
+    return ga_daily.natural_join(twitter_daily, on=["Date"])\
+        .update_view("Day = Date.toDateString()")
+
+def refresh_ga_twitter_daily(ga_tables, twitter_table, start_date, end_date):
+    """
+    Rewrites the days of the fact table in the given date range
+
+    Parameters:
+        ga_tables (list<Table>): The tables returned by GaCollector.collect_data
+        twitter_table (Table): A Twitter table created by TwitterCollector.twitter_analytics_data
+        start_date (DateTime): The start date as a Deephaven DateTime object
+        end_date (DateTime): The end date as a Deephaven DateTime object
+    Returns:
+        None
+    """
+    #collect_data alternates between the metrics table and the JSON table of each path
+    fact_table = build_ga_twitter_daily(merge(ga_tables[0::2]), twitter_table)
+    day = start_date
+    while day < end_date:
+        day_string = day.toDateString()
+        write(fact_table.where(f"Day == `{day_string}`").drop_columns(["Day"]), f"{FACT_PATH}Day={day_string}/0.parquet")
+        day = plus_nanos(day, ONE_DAY_NANOS)
+
+def read_ga_twitter_daily():
+    """
+    Reads the fact table. The Day column comes from the directory of each day
+
+    Returns:
+        Table: The fact table, or None if it hasn't been written yet
+    """
+    if not os.path.isdir(FACT_PATH):
+        return None
+    return read(FACT_PATH)
@@ -13,12 +13,15 @@ from deephaven.time import plus_period, minus_period, to_period
 from apiclient.discovery import build
 from oauth2client.service_account import ServiceAccountCredentials
 
-import time
+from functools import lru_cache
+
 import json
+import threading
 
 SCOPES = ['https://www.googleapis.com/auth/analytics.readonly']
 KEY_FILE_LOCATION = '/google-key.json'
 ONE_DAY = to_period("1D")
+URL_CACHE_SIZE = 65536 #Number of formatted paths to remember. Sites usually have far fewer distinct paths
 
 
 class GaCollector:
@@ -33,14 +36,25 @@ class GaCollector:
         view_id (str): The view ID for the Google Analytics account
         paths (list<str>): A list of paths to evaluate in Google Analytics
         metrics_collectors (list<MetricsCollector>): A list of MetricsCollector instances used for expression evaluation
-        analytics: An authorized Analytics Reporting API V4 service object.
+        analytics: An authorized Analytics Reporting API V4 service object, created on first use.
         ignore_query_strings (bool): If set to True, query strings are stripped away and ignored.
             Otherwise, query strings are normalized to a constant value.
         dimension_collectors (list<DimensionCollector>): A list of DimensionCollector instances used for expression evaluation
+        spill_path (str): If given, collected rows are spilled to Parquet files under this directory instead of
+            being kept in memory. Should end with /
+        adaptive_windows (bool): If set to True, date_increment is ignored and the number of days in each request
+            is adjusted per path. Windows are halved when the response is sampled or needs more than max_pages pages,
+            and doubled (up to max_window_days) when the response has fewer than page_size * small_window_ratio rows.
+            Windows are never widened back to a size that was already split for the path. Rows are still written per day,
+            but a JSON response covers the whole window, from its Date to its EndDate.
+        max_window_days (int): The largest number of days in an adaptive window
+        max_pages (int): The number of pages an adaptive window can take before it is split
+        small_window_ratio (float): The fraction of page_size below which an adaptive window is widened
     """
     def __init__(self, start_date=None, end_date=None, date_increment=None, page_size=None,
                  view_id=None, paths=None, metrics_collectors=None, ignore_query_strings=True,
-                 dimension_collectors=None):
+                 dimension_collectors=None, spill_path=None, adaptive_windows=False, max_window_days=7,
+                 max_pages=1, small_window_ratio=0.1):
         self.start_date = start_date
         self.end_date = end_date
         self.date_increment = date_increment
@@ -50,11 +64,17 @@ class GaCollector:
         self.metrics_collectors = metrics_collectors
         self.ignore_query_strings = ignore_query_strings
         self.dimension_collectors = dimension_collectors
+        self.spill_path = spill_path
+        self.adaptive_windows = adaptive_windows
+        self.max_window_days = max_window_days
+        self.max_pages = max_pages
+        self.small_window_ratio = small_window_ratio
+
+    @property
+    def analytics(self):
+        return get_analyticsreporting()
 
-        #Create analytics class
-        self.analytics = initialize_analyticsreporting()
-    
-    def _get_google_analytics_report(self, path, start_date, end_date, page_token=None):
+    def _get_google_analytics_report(self, path, start_date, end_date, page_token=None, include_date=False):
       """Queries the Analytics Reporting API V4.
 
       Modified function taken from https://developers.google.com/analytics/devguides/reporting/core/v4/quickstart/service-py
@@ -63,6 +83,7 @@ class GaCollector:
         path (str): The path to evaluate the expression on.
         ga_collector (GaCollector): The GaCollector instance that defines what to pull
         page_token (str): The page token if making a subsequent request.
+        include_date (bool): If set to True, the ga:date dimension is added after the other dimensions.
       Returns:
         dict: The Analytics Reporting API V4 response.
       """
@@ -72,6 +93,8 @@ class GaCollector:
       dimensions = []
       for dimension_collector in self.dimension_collectors:
           dimensions.append({'name': dimension_collector.expression})
+      if include_date:
+          dimensions.append({'name': 'ga:date'})
       body = {
         'reportRequests': [
           {
@@ -102,17 +125,20 @@ class GaCollector:
       if page_token is not None:
         body['reportRequests'][0]['pageToken'] = page_token
 
+      GA_RATE_LIMITER.wait() #Wait to avoid rate limits, shared with every other thread making requests
       return self.analytics.reports().batchGet(body=body).execute()
 
-    def _google_analytics_table_writer(self, path):
+    def _google_analytics_table_writer(self, path, spill_paths=(None, None)):
         """
         Table writer for the google analytics collector. This pulls day-by-day information from
         the google analytics API for the given path, and returns a Deephaven table of this information
 
         Parameters:
             path (str): The path to collect data on
+            spill_paths (tuple(str, str)): The directories to spill the day-by-day data and the JSON responses to, if any
         Returns:
             tuple(Table, Table): A Deephaven table containing the day-by-day data, and a Deephaven table of the JSON responses
+                with the first (Date) and last (EndDate) day each response covers
         """
         #Create the table writer
         metrics_collector_columns = {}
@@ -124,13 +150,18 @@ class GaCollector:
             "Source": dht.string,
         }
         dtw_columns.update(metrics_collector_columns)
-        table_writer = DynamicTableWriter(dtw_columns)
+        table_writer = new_table_writer(dtw_columns, spill_path=spill_paths[0])
 
         dtw_columns_json = {
             "Date": dht.DateTime,
+            "EndDate": dht.DateTime,
             "JsonString": dht.string
         }
-        table_writer_json = DynamicTableWriter(dtw_columns_json)
+        table_writer_json = new_table_writer(dtw_columns_json, spill_path=spill_paths[1])
+
+        if self.adaptive_windows:
+            self._write_adaptive_windows(path, table_writer, table_writer_json)
+            return (table_writer.table, table_writer_json.table)
 
         #Loop through the date range
         current_date = self.start_date
@@ -149,13 +180,12 @@ class GaCollector:
             while True:
                 response = self._get_google_analytics_report(path, current_date_string,
                                                              next_date_string, page_token=next_page_token)
-                time.sleep(1) #Sleep to avoid rate limits for subsequent calls
                 parsed_counts = parse_ga_response(response, self.metrics_collectors, self.ignore_query_strings)
                 next_page_token = response["reports"][0].get("nextPageToken")
 
                 for row_to_write in parsed_counts:
                     table_writer.write_row([current_date] + row_to_write)
-                table_writer_json.write_row(current_date, json.dumps(response))
+                table_writer_json.write_row(current_date, next_date, json.dumps(response))
 
                 #If no pagination, break
                 if next_page_token is None:
@@ -165,6 +195,120 @@ class GaCollector:
 
         return (table_writer.table, table_writer_json.table)
 
+    def _write_adaptive_windows(self, path, table_writer, table_writer_json):
+        """
+        Pulls the date range for the given path in windows whose size adapts to the responses,
+        and writes the rows of each day with that day's date.
+
+        Parameters:
+            path (str): The path to collect data on
+            table_writer (DynamicTableWriter): The table writer for the day-by-day data
+            table_writer_json (DynamicTableWriter): The table writer for the JSON responses
+        Returns:
+            None
+        """
+        window_days = 1
+        #Smallest window size that had to be split. Sampling depends on sessions rather than rows, so
+        #widening back to a size that was split would just get it sampled and split again
+        window_ceiling = self.max_window_days + 1
+        current_date = self.start_date
+        while current_date < self.end_date:
+            #Days of the window by their ga:date value (yyyymmdd)
+            days = {}
+            day = current_date
+            while len(days) < window_days and day < self.end_date:
+                days[day.toDateString().replace("-", "")] = day
+                last_day = day
+                day = plus_period(day, ONE_DAY)
+            print("Google")
+            print(f"{current_date} ({len(days)} days)")
+
+            #Pages of a multi-day window are held until the window is known not to need splitting. A single day
+            #window is never split, so its pages are written as they arrive
+            responses = []
+            pages = 0
+            row_count = 0
+            sampled = False
+            split = False
+            next_page_token = None
+            while True:
+                response = self._get_google_analytics_report(path, current_date.toDateString(), last_day.toDateString(),
+                                                             page_token=next_page_token, include_date=True)
+                pages += 1
+                next_page_token = response["reports"][0].get("nextPageToken")
+
+                #Sampled or heavily paginated windows are retried with fewer days, unless they are a single day
+                if len(days) > 1 and (is_sampled(response) or (not (next_page_token is None) and pages >= self.max_pages)):
+                    split = True
+                    break
+
+                responses.append(response)
+                sampled = sampled or is_sampled(response)
+                if len(days) == 1:
+                    row_count += self._write_window_responses(responses, days, last_day, table_writer, table_writer_json)
+                    responses = []
+
+                #If no pagination, break
+                if next_page_token is None:
+                    break
+
+            if split:
+                window_ceiling = min(window_ceiling, len(days))
+                window_days = max(1, len(days) // 2)
+                print(f"Splitting window to {window_days} days")
+                continue
+
+            row_count += self._write_window_responses(responses, days, last_day, table_writer, table_writer_json)
+
+            if row_count < self.page_size * self.small_window_ratio and not sampled:
+                window_days = min(self.max_window_days, window_days * 2, window_ceiling - 1)
+            current_date = day
+
+    def _write_window_responses(self, responses, days, last_day, table_writer, table_writer_json):
+        """
+        Writes the rows of the responses of an adaptive window with the date of each row's day,
+        and the JSON responses with the first and last day of the window.
+
+        Parameters:
+            responses (list<dict>): The responses to write
+            days (dict<str, DateTime>): The days of the window by their ga:date value (yyyymmdd)
+            last_day (DateTime): The last day of the window
+            table_writer (DynamicTableWriter): The table writer for the day-by-day data
+            table_writer_json (DynamicTableWriter): The table writer for the JSON responses
+        Returns:
+            int: The number of rows written
+        """
+        first_day = next(iter(days.values()))
+        row_count = 0
+        for response in responses:
+            for row_to_write in parse_ga_response(response, self.metrics_collectors, self.ignore_query_strings, include_date=True):
+                table_writer.write_row([days[row_to_write[0]]] + row_to_write[1:])
+                row_count += 1
+            table_writer_json.write_row(first_day, last_day, json.dumps(response))
+        return row_count
+
+    def collect_day(self, path, date):
+        """
+        Collects the rows for a single day for the given path. This is used to poll the current day,
+        whose counts keep changing until the day is over.
+
+        Parameters:
+            path (str): The path to collect data on
+            date (DateTime): The day to collect data on
+        Returns:
+            list<list>: A list of lists showing each row to write
+        """
+        date_string = date.toDateString()
+        rows = []
+        next_page_token = None
+        while True:
+            response = self._get_google_analytics_report(path, date_string, date_string, page_token=next_page_token)
+            rows.extend(parse_ga_response(response, self.metrics_collectors, self.ignore_query_strings))
+            next_page_token = response["reports"][0].get("nextPageToken")
+            if next_page_token is None:
+                break
+        return rows
+
     def collect_data(self):
         """
         Main method for the google analytics collector. For every path, every expression is evaluated and stored in a Deephaven table,
@@ -175,7 +319,10 @@ class GaCollector:
         """
         tables = []
         for path in self.paths:
-            (result_table, json_table) = self._google_analytics_table_writer(path)
+            spill_paths = (None, None)
+            if not (self.spill_path is None):
+                spill_paths = (f"{self.spill_path}{len(tables)}/", f"{self.spill_path}{len(tables) + 1}/")
+            (result_table, json_table) = self._google_analytics_table_writer(path, spill_paths=spill_paths)
             tables.append(result_table)
             tables.append(json_table)
         return tables
@@ -208,10 +355,13 @@ class DimensionCollector:
         self.expression = expression
         self.metric_column_name = metric_column_name
 
+@lru_cache(maxsize=URL_CACHE_SIZE)
 def path_format(strn, ignore_query_strings):
     """
     Formats the path. For now, just unifies query parameters.
 
+    Results are cached, since the same paths show up on every page and for every date.
+
     Parameters:
         strn (str): The path to format.
         ignore_query_strings (bool): If set to True, query strings are stripped away and ignored.
@@ -230,7 +380,7 @@ def path_format(strn, ignore_query_strings):
         result = strn
     return result
 
-def parse_ga_response(d, metrics_collectors, ignore_query_strings):
+def parse_ga_response(d, metrics_collectors, ignore_query_strings, include_date=False):
     """
     Custom parser for the GA API response
 
@@ -239,6 +389,8 @@ def parse_ga_response(d, metrics_collectors, ignore_query_strings):
         metrics_collectors (list<MetricsCollector>): A list of metrics collectors that contain the converter methods
         ignore_query_strings (bool): If set to True, query strings are stripped away and ignored.
             Otherwise, query strings are normalized to a constant value.
+        include_date (bool): If set to True, the response contains the ga:date dimension as its last dimension,
+            and its value (yyyymmdd) is the first value of each row.
     Returns:
         list<list>: A list of lists showing each row to write
     """
@@ -248,6 +400,8 @@ def parse_ga_response(d, metrics_collectors, ignore_query_strings):
             if "rows" in report["data"].keys():
                 for rows in report["data"]["rows"]:
                     metrics_values = []
+                    if include_date:
+                        metrics_values.append(rows["dimensions"][-1])
                     url = path_format(rows["dimensions"][0], ignore_query_strings)
                     source = rows["dimensions"][1]
                     metrics_values.append(url)
@@ -259,9 +413,26 @@ def parse_ga_response(d, metrics_collectors, ignore_query_strings):
                     values.append(metrics_values)
     return values
 
+def is_sampled(d):
+    """
+    Determines if the GA API response is based on sampled data
+
+    Parameters:
+        d (dict): The dictionary response from the Google Analytics API
+    Returns:
+        bool: True if any report in the response is sampled, False otherwise
+    """
+    for report in d["reports"]:
+        if "samplesReadCounts" in report.get("data", {}).keys():
+            return True
+    return False
+
 def initialize_analyticsreporting():
     """Initializes an Analytics Reporting API V4 service object.
 
+    The discovery document is loaded from the copy bundled with google-api-python-client
+    instead of being fetched, so this doesn't make any network calls.
+
     Returns:
         An authorized Analytics Reporting API V4 service object.
     """
@@ -269,6 +440,22 @@ def initialize_analyticsreporting():
         KEY_FILE_LOCATION, SCOPES)
 
     # Build the service object.
-    analytics = build('analyticsreporting', 'v4', credentials=credentials)
+    analytics = build('analyticsreporting', 'v4', credentials=credentials,
+                      static_discovery=True, cache_discovery=False)
 
     return analytics
+
+_analyticsreporting = threading.local()
+
+def get_analyticsreporting():
+    """Returns the Analytics Reporting API V4 service object shared across collectors.
+
+    The service object is created on first use. Its HTTP connection is kept alive between requests,
+    but it isn't thread safe, so each thread gets its own service object.
+
+    Returns:
+        An authorized Analytics Reporting API V4 service object.
+    """
+    if not hasattr(_analyticsreporting, "analytics"):
+        _analyticsreporting.analytics = initialize_analyticsreporting()
+    return _analyticsreporting.analytics
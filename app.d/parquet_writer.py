@@ -3,10 +3,115 @@ parquet_writer.py
 
 A python script that contains simple parquet file reader and writer methods
 """
+from deephaven import DynamicTableWriter, merge, new_table
+from deephaven.column import InputColumn
 from deephaven.parquet import read, write
 
 import os
 
+CHECKPOINT_FILE = "_COMPLETE"
+SPILL_ROW_GROUP_SIZE = 50000 #Number of rows a ParquetSpillWriter keeps in memory before writing them
+SPILL_MAX_BYTES = 64 * 1024 * 1024 #Approximate size of the rows a ParquetSpillWriter keeps in memory before writing them
+
+class ParquetSpillWriter:
+    """
+    A table writer that keeps a bounded amount of data in memory. Rows are written to a new Parquet file
+    once there are row_group_size of them or their approximate size reaches max_bytes, whichever comes
+    first, and the resulting table reads all of the written files. The size counts the length of string
+    values (such as JSON responses) and 8 bytes for every other value.
+
+    It can be used in place of a DynamicTableWriter, but the table is static and only contains the rows
+    written before it is retrieved.
+
+    Attributes:
+        columns (dict<str, dht.type>): The Deephaven types by column name
+        path (str): The directory to write the Parquet files to. Should end with /
+        row_group_size (int): The largest number of rows in each Parquet file
+        max_bytes (int): The largest approximate size of the rows in each Parquet file
+        rows (list<list>): The rows that haven't been written yet
+        buffered_bytes (int): The approximate size of the rows that haven't been written yet
+        part_paths (list<str>): The paths of the written Parquet files
+    """
+    def __init__(self, columns, path, row_group_size=SPILL_ROW_GROUP_SIZE, max_bytes=SPILL_MAX_BYTES):
+        self.columns = columns
+        self.path = path
+        self.row_group_size = row_group_size
+        self.max_bytes = max_bytes
+        self.rows = []
+        self.buffered_bytes = 0
+        self.part_paths = []
+
+        #Clear out the files of a previous collection that was interrupted
+        os.makedirs(path, exist_ok=True)
+        for file_name in os.listdir(path):
+            if file_name.endswith(".parquet"):
+                os.remove(f"{path}{file_name}")
+
+    def write_row(self, *values):
+        """
+        Adds a row, writing the buffered rows to Parquet once there are row_group_size of them
+        or they reach max_bytes
+
+        Parameters:
+            values: The values of the row, either as separate arguments or as a single list
+        Returns:
+            None
+        """
+        if len(values) == 1 and isinstance(values[0], list):
+            values = values[0]
+        self.rows.append(list(values))
+        for value in values:
+            self.buffered_bytes += len(value) if isinstance(value, str) else 8
+        if len(self.rows) >= self.row_group_size or self.buffered_bytes >= self.max_bytes:
+            self.flush()
+
+    def flush(self):
+        """
+        Writes the buffered rows to a new Parquet file
+
+        Returns:
+            None
+        """
+        if len(self.rows) == 0:
+            return
+        input_columns = []
+        for (i, (column_name, dh_type)) in enumerate(self.columns.items()):
+            input_columns.append(InputColumn(name=column_name, data_type=dh_type, input_data=[row[i] for row in self.rows]))
+        part_path = f"{self.path}part-{len(self.part_paths):05d}.parquet"
+        write(new_table(input_columns), part_path)
+        self.part_paths.append(part_path)
+        self.rows = []
+        self.buffered_bytes = 0
+
+    @property
+    def table(self):
+        """
+        Writes the buffered rows, and returns a table that reads all of the written Parquet files
+
+        Returns:
+            Table: The Deephaven table
+        """
+        self.flush()
+        if len(self.part_paths) == 0:
+            return new_table([InputColumn(name=column_name, data_type=dh_type, input_data=[])
+                              for (column_name, dh_type) in self.columns.items()])
+        return merge([read(part_path) for part_path in self.part_paths])
+
+def new_table_writer(columns, spill_path=None):
+    """
+    Creates a table writer for a collector
+
+    Parameters:
+        columns (dict<str, dht.type>): The Deephaven types by column name
+        spill_path (str): If given, rows are spilled to Parquet files in this directory with a
+            ParquetSpillWriter. Otherwise they are kept in memory with a DynamicTableWriter
+    Returns:
+        DynamicTableWriter or ParquetSpillWriter: The table writer
+    """
+    if spill_path is None:
+        return DynamicTableWriter(columns)
+    return ParquetSpillWriter(columns, spill_path)
+
 def write_tables(tables=None, table=None, path=None):
     """
     Writes a list of tables to the given path
@@ -44,3 +149,45 @@ def read_tables(path=None):
         if len(file_path) > 0:
             tables.append(read(file_path))
     return tables
+
+def read_indexed_tables(path=None):
+    """
+    Reads the tables written by write_tables in the order they were written
+
+    Parameters:
+        path (str): The path to read tables from. Should end with /. Defaults to "/data/"
+    Returns:
+        list<tables>: A list of tables read, ordered by the index they were written with
+    """
+    tables = []
+    if path is None:
+        path = "/data/"
+    i = 0
+    while os.path.exists(f"{path}{i}.parquet"):
+        tables.append(read(f"{path}{i}.parquet"))
+        i += 1
+    return tables
+
+def write_checkpoint(path):
+    """
+    Marks the given path as complete. This should only be called once every table for the path is written
+
+    Parameters:
+        path (str): The path to mark as complete. Should end with /
+    Returns:
+        None
+    """
+    os.makedirs(path, exist_ok=True)
+    with open(f"{path}{CHECKPOINT_FILE}", "w") as f:
+        f.write("")
+
+def is_checkpointed(path):
+    """
+    Determines if the given path has been marked as complete by write_checkpoint
+
+    Parameters:
+        path (str): The path to check. Should end with /
+    Returns:
+        bool: True if the path is complete, False otherwise
+    """
+    return os.path.exists(f"{path}{CHECKPOINT_FILE}")
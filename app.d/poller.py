@@ -0,0 +1,280 @@
+"""
+poller.py
+
+A python script that keeps polling the data sources and appends new rows to live (ticking) tables,
+so the data in the Deephaven UI stays close to real time instead of being up to a day old.
+
+Each source polls incrementally from its own cursor:
+    Slack: messages newer than the last seen time stamp of each channel
+    Google Analytics: the counts for the current day
+    Twitter: the hourly stats for the current day
+
+The Google Analytics and Twitter counts for the current day keep changing until the day is over,
+so every changed row is appended with a PolledAt time stamp, and the *_latest tables show the
+most recent value of each row. Days are binned the same way as in scheduler.py, so the Date column
+matches the persisted tables. The time between polls shrinks while a source keeps returning new data
+and grows while it doesn't, bounded by POLL_MIN_SECONDS and POLL_MAX_SECONDS.
+
+The environmental variable POLLING needs to be set to true for the poller to run. The collector
+configuration is shared with scheduler.py.
+"""
+from deephaven import DynamicTableWriter
+import deephaven.dtypes as dht
+from deephaven.time import now, lower_bin, plus_nanos, TimeZone
+
+import os
+import threading
+import time
+
+POLL_MIN_SECONDS = int(os.environ.get("POLL_MIN_SECONDS", 120))
+POLL_MAX_SECONDS = int(os.environ.get("POLL_MAX_SECONDS", 1800))
+
+def current_day():
+    """
+    Returns the start of the current day, binned the same way as the dates in scheduler.py
+
+    Returns:
+        DateTime: The start of the current day
+    """
+    return lower_bin(now(), ONE_DAY_NANOS, offset=HOURS_NANOS_8)
+
+class AdaptiveInterval:
+    """
+    A class to represent the time between polls of a source. The interval is halved when a poll
+    finds new data, and doubled when it doesn't.
+
+    Attributes:
+        min_seconds (float): The shortest allowed interval
+        max_seconds (float): The longest allowed interval
+        seconds (float): The current interval
+    """
+    def __init__(self, min_seconds, max_seconds):
+        self.min_seconds = min_seconds
+        self.max_seconds = max_seconds
+        self.seconds = min_seconds
+
+    def update(self, new_rows):
+        """
+        Updates the interval based on the result of the latest poll
+
+        Parameters:
+            new_rows (int): The number of new rows found by the latest poll
+        Returns:
+            float: The new interval in seconds
+        """
+        if new_rows > 0:
+            self.seconds = max(self.min_seconds, self.seconds / 2)
+        else:
+            self.seconds = min(self.max_seconds, self.seconds * 2)
+        return self.seconds
+
+class GaPoller:
+    """
+    A class to poll the current day from Google Analytics
+
+    Attributes:
+        ga_collector (GaCollector): The collector used to make the requests
+        table_writer (DynamicTableWriter): The table writer for the live table
+        current_day (DateTime): The day that was polled last
+        last_rows (dict): The metrics last written for each URL and source, by path and day. Used to
+            only write the rows that changed
+    """
+    def __init__(self, ga_collector):
+        self.ga_collector = ga_collector
+        dtw_columns = {
+            "PolledAt": dht.DateTime,
+            "Date": dht.DateTime,
+            "URL": dht.string,
+            "Source": dht.string,
+        }
+        for metrics_collector in ga_collector.metrics_collectors:
+            dtw_columns[metrics_collector.metric_column_name] = metrics_collector.dh_type
+        self.table_writer = DynamicTableWriter(dtw_columns)
+        self.current_day = None
+        self.last_rows = {}
+
+    def poll(self):
+        """
+        Polls every path for the current day. When the day rolls over, the previous day is polled
+        one last time to pick up its final counts.
+
+        Returns:
+            int: The number of rows written
+        """
+        today = current_day()
+        days = [today]
+        if not (self.current_day is None) and self.current_day < today:
+            days.insert(0, self.current_day)
+        self.current_day = today
+        #Only the days being polled are kept, so the previous day's rows are compared on its last poll
+        day_strings = [day.toDateString() for day in days]
+        self.last_rows = {key: rows for (key, rows) in self.last_rows.items() if key[1] in day_strings}
+
+        new_rows = 0
+        polled_at = now()
+        for day in days:
+            for path in self.ga_collector.paths:
+                #Rows are grouped by URL and source, since stripping query strings can map several
+                #paths to the same URL
+                rows_by_key = {}
+                for row in self.ga_collector.collect_day(path, day):
+                    rows_by_key.setdefault((row[0], row[1]), []).append(row)
+
+                last_rows = self.last_rows.setdefault((path, day.toDateString()), {})
+                for (key, rows) in rows_by_key.items():
+                    if last_rows.get(key) == rows:
+                        continue
+                    last_rows[key] = rows
+                    for row_to_write in rows:
+                        self.table_writer.write_row([polled_at, day] + row_to_write)
+                    new_rows += len(rows)
+        return new_rows
+
+class TwitterPoller:
+    """
+    A class to poll the hourly stats of the current day from the Twitter Ads API
+
+    Attributes:
+        twitter_collector (TwitterCollector): The collector containing the analytics items to poll
+        table_writer (DynamicTableWriter): The table writer for the live table
+        current_day (DateTime): The day that was polled last
+        last_responses (dict): The JSON response last written for each analytics item, placement, and day
+    """
+    def __init__(self, twitter_collector):
+        self.twitter_collector = twitter_collector
+        dtw_columns = {
+            "PolledAt": dht.DateTime,
+            "Date": dht.DateTime,
+            "AccountName": dht.string,
+            "AnalyticsType": dht.string,
+            "AnalyticsId": dht.string,
+            "AnalyticsName": dht.string,
+            "Placement": dht.string,
+            "JsonString": dht.string,
+        }
+        self.table_writer = DynamicTableWriter(dtw_columns)
+        self.current_day = None
+        self.last_responses = {}
+
+    def poll(self):
+        """
+        Polls the current day for every analytics item that is running. When the day rolls over,
+        the previous day is polled one last time to pick up its final stats, and the analytics items
+        are reloaded so entities created since the last day are polled.
+
+        Returns:
+            int: The number of rows written
+        """
+        today = current_day()
+        days = [today]
+        if not (self.current_day is None) and self.current_day < today:
+            days.insert(0, self.current_day)
+            self.twitter_collector.load_analytics_items()
+        self.current_day = today
+        day_strings = [day.toDateString() for day in days]
+        self.last_responses = {key: json_str for (key, json_str) in self.last_responses.items() if key[2] in day_strings}
+
+        new_rows = 0
+        polled_at = now()
+        for day in days:
+            next_day = plus_nanos(day, ONE_DAY_NANOS)
+            for (api_name, table_name, account, analytics, out_of_range) in self.twitter_collector.analytics_items:
+                if out_of_range(analytics, day, next_day):
+                    continue
+                for placement in ["PUBLISHER_NETWORK", "ALL_ON_TWITTER"]:
+                    json_str = get_analytics_metrics(account, analytics, day, next_day, placement, api_name)
+                    key = (analytics.id, placement, day.toDateString())
+                    if self.last_responses.get(key) == json_str:
+                        continue
+                    self.last_responses[key] = json_str
+                    name = None
+                    if hasattr(analytics, "name"):
+                        name = analytics.name
+                    self.table_writer.write_row(polled_at, day, account.name, table_name, analytics.id, name, placement, json_str)
+                    new_rows += 1
+        return new_rows
+
+class SlackPoller:
+    """
+    A class to poll Slack for new messages in every public channel
+
+    Note that replies to threads that started before the last poll are not picked up, since the
+    history endpoint only returns the parent message of a thread.
+
+    Attributes:
+        table_writer (DynamicTableWriter): The table writer for the live table
+        start_seconds (str): The time stamp to start polling channels from, in seconds since the Epoch
+        cursors (dict<str, str>): The newest message time stamp seen in each channel
+    """
+    def __init__(self, start_time):
+        self.table_writer = DynamicTableWriter(SLACK_MESSAGE_COLUMNS)
+        self.start_seconds = str(start_time.getMillis()/1000)
+        self.cursors = {}
+
+    def poll(self):
+        """
+        Polls every public channel for messages newer than its cursor
+
+        Returns:
+            int: The number of channels with new messages
+        """
+        new_channels = 0
+        for (channel_id, _, _) in get_public_channels():
+            oldest = self.cursors.get(channel_id, self.start_seconds)
+            newest_ts = write_channel_messages(self.table_writer, channel_id, oldest=oldest)
+            if not (newest_ts is None):
+                self.cursors[channel_id] = newest_ts
+                new_channels += 1
+        return new_channels
+
+def start_polling(name, poll_method, interval):
+    """
+    Runs the poll method forever in a background thread, sleeping for the adaptive interval between polls
+
+    Parameters:
+        name (str): The name of the source, used for logging
+        poll_method (method): A method that polls the source and returns the number of new rows
+        interval (AdaptiveInterval): The interval between polls
+    Returns:
+        Thread: The polling thread
+    """
+    def run():
+        while True:
+            try:
+                new_rows = poll_method()
+            except Exception as e:
+                print(f"{name} poll failed: {e}")
+                new_rows = 0
+            seconds = interval.update(new_rows)
+            print(f"{name} poll wrote {new_rows} new rows, polling again in {seconds} seconds")
+            time.sleep(seconds)
+
+    thread = threading.Thread(target=run, name=f"{name}-poller", daemon=True)
+    thread.start()
+    return thread
+
+if not bool(os.environ.get("POLLING", False)):
+    print("POLLING needs to be set to \"true\" to run the poller. Skipping the poller...")
+else:
+    TimeZone.set_default_timezone(TimeZone.UTC)
+
+    ga_poller = GaPoller(GaCollector(page_size=page_size, view_id=view_id, paths=paths,
+                                     metrics_collectors=metrics_collectors, dimension_collectors=dimension_collectors))
+    twitter_poller = TwitterPoller(TwitterCollector(get_twitter_client(), analytics_types))
+    slack_poller = SlackPoller(current_day())
+
+    poll_ga_table = ga_poller.table_writer.table
+    #Several rows can share a URL and source, and all of them are written with the same PolledAt whenever
+    #one of them changes, so the latest rows are every row from the last poll that wrote the key
+    poll_ga_latest = poll_ga_table.natural_join(poll_ga_table.view(["Date", "URL", "Source", "LastPolledAt = PolledAt"]).last_by(["Date", "URL", "Source"]),
+                                                on=["Date", "URL", "Source"], joins=["LastPolledAt"])\
+        .where("PolledAt == LastPolledAt")\
+        .drop_columns(["LastPolledAt"])
+    poll_twitter_table = twitter_poller.table_writer.table
+    #Keyed by id, since names aren't unique and promoted tweets have no name
+    poll_twitter_latest = poll_twitter_table.last_by(["Date", "AccountName", "AnalyticsType", "AnalyticsId", "Placement"])
+    poll_slack_messages = slack_poller.table_writer.table
+
+    start_polling("Google", ga_poller.poll, AdaptiveInterval(POLL_MIN_SECONDS, POLL_MAX_SECONDS))
+    start_polling("Twitter", twitter_poller.poll, AdaptiveInterval(POLL_MIN_SECONDS, POLL_MAX_SECONDS))
+    start_polling("Slack", slack_poller.poll, AdaptiveInterval(POLL_MIN_SECONDS, POLL_MAX_SECONDS))
@@ -0,0 +1,41 @@
+"""
+rate_limiter.py
+
+Rate limiters shared by every collector, so API calls made from several threads (the scheduler's
+shards and the poller) stay within each API's rate limits together.
+
+This file does not create any tables or plots in Deephaven.
+"""
+import threading
+import time
+
+class RateLimiter:
+    """
+    A class to represent the minimum time between calls to an API, shared by every thread
+
+    Attributes:
+        interval_seconds (float): The minimum time between calls
+        next_time (float): The earliest time.monotonic() value the next call can be made at
+        lock (Lock): The lock protecting next_time
+    """
+    def __init__(self, interval_seconds):
+        self.interval_seconds = interval_seconds
+        self.next_time = 0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        """
+        Blocks until the calling thread can make its next call. Calls are given out in the order
+        threads ask for them, each interval_seconds after the previous one.
+
+        Returns:
+            None
+        """
+        with self.lock:
+            call_time = max(time.monotonic(), self.next_time)
+            self.next_time = call_time + self.interval_seconds
+        time.sleep(max(0, call_time - time.monotonic()))
+
+GA_RATE_LIMITER = RateLimiter(1)
+TWITTER_RATE_LIMITER = RateLimiter(4)
+SLACK_RATE_LIMITER = RateLimiter(1.2)
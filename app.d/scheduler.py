@@ -4,69 +4,190 @@ scheduler.py
 A python script that runs various collectors on a timed basis. For best performance, this should be run
 on a daily basis at 14:00 UTC. This guarantees that the APIs have collected all the data for the previous day,
 and avoids weirdness with daylight savings.
+
+Large date ranges are split into shards of SHARD_DAYS days, and up to SHARD_WORKERS shards are collected at once.
+Each shard is written to Parquet as soon as it is collected and then marked as complete, so restarting a backfill
+skips the shards that are already done.
 """
-from deephaven.time import now, lower_bin, minus_nanos, TimeZone
+from deephaven import merge
+from deephaven.time import now, lower_bin, minus_nanos, plus_nanos, TimeZone
 
+from concurrent.futures import ThreadPoolExecutor
 import os
+import shutil
 import sys
 
+ONE_DAY_NANOS = 86400000000000
+HOURS_NANOS_8 = 28800000000000
+
+def date_shards(start_date, end_date, shard_days):
+    """
+    Splits the date range into shards of the given number of days. The last shard may be shorter.
+
+    Parameters:
+        start_date (DateTime): The start date as a Deephaven DateTime object
+        end_date (DateTime): The end date as a Deephaven DateTime object
+        shard_days (int): The number of days in each shard
+    Returns:
+        list<tuple(DateTime, DateTime)>: The start and end dates of each shard
+    """
+    shards = []
+    current_date = start_date
+    while current_date < end_date:
+        next_date = plus_nanos(current_date, ONE_DAY_NANOS * shard_days)
+        if next_date > end_date:
+            next_date = end_date
+        shards.append((current_date, next_date))
+        current_date = next_date
+    return shards
+
+def merge_shard_tables(shard_paths, source):
+    """
+    Reads the tables of a source from every shard and merges them by the index they were written with
+
+    Parameters:
+        shard_paths (list<str>): The paths of the shards. Each should end with /
+        source (str): The directory of the source within each shard. Should end with /
+    Returns:
+        list<Table>: The merged tables
+    """
+    tables_by_index = []
+    for shard_path in shard_paths:
+        for (i, table) in enumerate(read_indexed_tables(path=f"{shard_path}{source}")):
+            if i == len(tables_by_index):
+                tables_by_index.append([])
+            tables_by_index[i].append(table)
+    return [merge(tables) for tables in tables_by_index]
+
+def collect_shard(shard_start, shard_end, shard_path, twitter_collector):
+    """
+    Collects a shard from every data source, writes its tables, and marks it as complete.
+    Shards collected at the same time share the rate limiters of each API.
+
+    Parameters:
+        shard_start (DateTime): The start date of the shard as a Deephaven DateTime object
+        shard_end (DateTime): The end date of the shard as a Deephaven DateTime object
+        shard_path (str): The directory to write the shard to. Should end with /
+        twitter_collector (TwitterCollector): The collector containing the Twitter analytics items
+    Returns:
+        None
+    """
+    print(f"Collecting shard {shard_path}")
+    #Collected rows are spilled to Parquet as they arrive to keep memory bounded, and the spilled
+    #files are removed once the shard's tables are written
+    spill_path = f"{shard_path}spill/"
+    ga_collector = GaCollector(start_date=shard_start, end_date=shard_end, page_size=page_size, view_id=view_id,
+                               date_increment=date_increment, paths=paths, metrics_collectors=metrics_collectors,
+                               dimension_collectors=dimension_collectors, spill_path=f"{spill_path}google/",
+                               adaptive_windows=True)
+    ga_tables = ga_collector.collect_data()
+
+    twitter_analytics_table = twitter_collector.twitter_analytics_data(shard_start, shard_end, date_increment,
+                                                                       spill_path=f"{spill_path}twitter/")
+
+    (slack_channels, slack_messages) = get_all_slack_messages(start_time=shard_start, end_time=shard_end,
+                                                              spill_path=f"{spill_path}slack-messages/")
+
+    write_tables(tables=ga_tables, path=f"{shard_path}google/")
+    write_tables(table=twitter_analytics_table, path=f"{shard_path}twitter/")
+    write_tables(table=slack_channels, path=f"{shard_path}slack-channels/")
+    write_tables(table=slack_messages, path=f"{shard_path}slack-messages/")
+    refresh_ga_twitter_daily(ga_tables, twitter_analytics_table, shard_start, shard_end)
+    shutil.rmtree(spill_path)
+    if shard_start < shard_end:
+        write_checkpoint(shard_path)
+
+#Collector configuration. This is also used by poller.py
+###Google
+dimension_collectors = [
+    DimensionCollector(expression="ga:pagePath", metric_column_name="PagePath"),
+    DimensionCollector(expression="ga:sourceMedium", metric_column_name="SourceMedium")
+]
+metrics_collectors = [
+    MetricsCollector(expression="ga:pageViews", metric_column_name="PageViews", dh_type=dht.int_, converter=int),
+    MetricsCollector(expression="ga:uniquePageViews", metric_column_name="UniqueViews", dh_type=dht.double, converter=float),
+    MetricsCollector(expression="ga:bounceRate", metric_column_name="BounceRate", dh_type=dht.double, converter=float),
+    MetricsCollector(expression="ga:users", metric_column_name="Users", dh_type=dht.int_, converter=int)
+]
+paths = [
+    "/",
+]
+page_size = 100000
+view_id = "181392643"
+date_increment = to_period("1D")
+
+###Twitter
+analytics_types = [
+    ("CAMPAIGN", "Campaign", get_campaigns, analytics_out_of_range),
+    ("LINE_ITEM", "AdGroup", get_line_items, analytics_out_of_range),
+    ("FUNDING_INSTRUMENT", "FundingInstrument", get_funding_instruments, analytics_out_of_range),
+    ("PROMOTED_TWEET", "PromotedTweet", get_promoted_tweets, promoted_tweet_out_of_range),
+    ("MEDIA_CREATIVE", "MediaCreative", get_media_creatives, analytics_out_of_range)
+]
+
 if not bool(os.environ.get("SCHEDULED", False)):
     print("SCHEDULED needs to be set to \"true\" to run the scheduler. Skipping the scheduler...")
 else:
-    ONE_DAY_NANOS = 86400000000000
-    HOURS_NANOS_8 = 28800000000000
     DAYS_OFFSET = int(os.environ.get("DAYS_OFFSET", 1))
+    SHARD_DAYS = int(os.environ.get("SHARD_DAYS", 1))
+    if SHARD_DAYS < 1:
+        raise ValueError(f"SHARD_DAYS needs to be at least 1, got {SHARD_DAYS}")
+    SHARD_WORKERS = int(os.environ.get("SHARD_WORKERS", 1))
+    if SHARD_WORKERS < 1:
+        raise ValueError(f"SHARD_WORKERS needs to be at least 1, got {SHARD_WORKERS}")
 
     TimeZone.set_default_timezone(TimeZone.UTC)
 
     end_date = lower_bin(now(), ONE_DAY_NANOS, offset=HOURS_NANOS_8)
     start_date = minus_nanos(end_date, ONE_DAY_NANOS * DAYS_OFFSET)
 
-    ###Google
-    dimension_collectors = [
-        DimensionCollector(expression="ga:pagePath", metric_column_name="PagePath"),
-        DimensionCollector(expression="ga:sourceMedium", metric_column_name="SourceMedium")
-    ]
-    metrics_collectors = [
-        MetricsCollector(expression="ga:pageViews", metric_column_name="PageViews", dh_type=dht.int_, converter=int),
-        MetricsCollector(expression="ga:uniquePageViews", metric_column_name="UniqueViews", dh_type=dht.double, converter=float),
-        MetricsCollector(expression="ga:bounceRate", metric_column_name="BounceRate", dh_type=dht.double, converter=float),
-        MetricsCollector(expression="ga:users", metric_column_name="Users", dh_type=dht.int_, converter=int)
-    ]
-    paths = [
-        "/",
-    ]
-    page_size = 100000
-    view_id = "181392643"
-    date_increment = to_period("1D")
-
-    ga_collector = GaCollector(start_date=start_date, end_date=end_date, page_size=page_size, view_id=view_id,
-                               date_increment=date_increment, paths=paths, metrics_collectors=metrics_collectors,
-                               dimension_collectors=dimension_collectors)
+    ###Twitter
+    twitter_collector = TwitterCollector(get_twitter_client(), analytics_types)
 
-    ga_tables = ga_collector.collect_data()
+    ###Collect and write each shard
+    #With a 0 day offset there are no shards, but a single empty shard still builds (empty) tables.
+    #The empty shard is never checkpointed, so a dry run doesn't mark any day as collected
+    shards = date_shards(start_date, end_date, SHARD_DAYS)
+    if len(shards) == 0:
+        shards = [(start_date, end_date)]
+
+    shard_paths = []
+    with ThreadPoolExecutor(max_workers=SHARD_WORKERS) as executor:
+        futures = []
+        for (shard_start, shard_end) in shards:
+            #Shards are keyed by both dates, so changing SHARD_DAYS doesn't skip days covered by a shorter shard
+            shard_path = f"/data/{shard_start.toDateString()}_{shard_end.toDateString()}/"
+            shard_paths.append(shard_path)
+
+            if is_checkpointed(shard_path):
+                print(f"Shard {shard_path} already written, skipping")
+                continue
+            futures.append(executor.submit(collect_shard, shard_start, shard_end, shard_path, twitter_collector))
+
+        #Every shard runs to completion and is checkpointed on its own, so a failed shard only fails the run
+        #after the other shards are written
+        for future in futures:
+            future.result()
+
+    ###Twitter metadata
+    #Metadata is a snapshot of the account rather than date ranged data, so it is collected once per run
+    #and only the entities that changed since the previous run are written
+    (twitter_metadata_changes, twitter_metadata_versions) = twitter_collector.twitter_analytics_metadata(end_date, read_metadata_versions())
+    write_twitter_metadata(twitter_metadata_changes, twitter_metadata_versions, end_date)
+
+    ###Load the written shards
+    ga_tables = merge_shard_tables(shard_paths, "google/")
     for i in range(len(ga_tables)):
         globals()[f"ga_table{i}"] = ga_tables[i]
 
-    ###Twitter
-    analytics_types = [
-        ("CAMPAIGN", "Campaign", get_campaigns, analytics_out_of_range),
-        ("LINE_ITEM", "AdGroup", get_line_items, analytics_out_of_range),
-        ("FUNDING_INSTRUMENT", "FundingInstrument", get_funding_instruments, analytics_out_of_range),
-        ("PROMOTED_TWEET", "PromotedTweet", get_promoted_tweets, promoted_tweet_out_of_range),
-        ("MEDIA_CREATIVE", "MediaCreative", get_media_creatives, analytics_out_of_range)
-    ]
-    twitter_collector = TwitterCollector(twitter_client, analytics_types)
-
-    twitter_analytics_table = twitter_collector.twitter_analytics_data(start_date, end_date, date_increment)
-    twitter_metadata = twitter_collector.twitter_analytics_metadata()
-
-    ###Slack
-    (slack_channels, slack_messages) = get_all_slack_messages(start_time=start_date, end_time=end_date)
-
-    ###Write tables
-    write_tables(tables=ga_tables, path=f"/data/{start_date.toDateString()}/google/")
-    write_tables(table=twitter_analytics_table, path=f"/data/{start_date.toDateString()}/twitter/")
-    write_tables(table=twitter_metadata, path=f"/data/{start_date.toDateString()}/twitter-metadata/")
-    write_tables(table=slack_channels, path=f"/data/{start_date.toDateString()}/slack-channels/")
-    write_tables(table=slack_messages, path=f"/data/{start_date.toDateString()}/slack-messages/")
+    twitter_analytics_table = merge_shard_tables(shard_paths, "twitter/")[0]
+    slack_channels = read_indexed_tables(path=f"{shard_paths[-1]}slack-channels/")[0]
+    slack_messages = merge_shard_tables(shard_paths, "slack-messages/")[0]
+
+    ga_twitter_daily = read_ga_twitter_daily()
+    if ga_twitter_daily is None:
+        ga_twitter_daily = build_ga_twitter_daily(merge(ga_tables[0::2]), twitter_analytics_table)
+
+    (twitter_metadata_tables, twitter_metadata) = read_twitter_metadata()
+    for (table_name, table) in twitter_metadata_tables.items():
+        globals()[f"twitter_metadata_{table_name}"] = table
@@ -17,13 +17,36 @@ from slack_sdk import WebClient
 import os
 import time
 import json
+import threading
 
 SLACK_API_TOKEN = os.environ.get("SLACK_API_TOKEN")
 
-slack_client = WebClient(token=SLACK_API_TOKEN)
+_slack_client = None
+_slack_client_lock = threading.Lock()
+
+def get_slack_client():
+    """
+    Returns the Slack client shared across collectors. The client is created on first use,
+    so loading this file doesn't depend on the Slack API.
+
+    Returns:
+        WebClient: The Slack client to make API calls
+    """
+    global _slack_client
+    with _slack_client_lock:
+        if _slack_client is None:
+            _slack_client = WebClient(token=SLACK_API_TOKEN)
+        return _slack_client
+
+SLACK_MESSAGE_COLUMNS = {
+    "ChannelID": dht.string,
+    "TS": dht.string,
+    "Text": dht.string,
+    "JsonString": dht.string,
+}
 
 def get_channel_info(slack_channel):
-    return slack_client.conversations_info(channel=slack_channel)
+    return get_slack_client().conversations_info(channel=slack_channel)
 
 def get_public_channels():
     """
@@ -35,7 +58,7 @@ def get_public_channels():
     cursor = None
     channels = []
     while True:
-        response = slack_client.conversations_list(cursor=cursor)
+        response = get_slack_client().conversations_list(cursor=cursor)
 
         for channel in response["channels"]:
             channels.append((channel["id"], channel["name"], json.dumps(channel)))
@@ -65,8 +88,8 @@ def get_thread_messages(slack_channel, ts):
     next_cursor = None
 
     while True:
-        thread_replies = slack_client.conversations_replies(channel=slack_channel, ts=ts, cursor=next_cursor)
-        time.sleep(1.2)
+        SLACK_RATE_LIMITER.wait()
+        thread_replies = get_slack_client().conversations_replies(channel=slack_channel, ts=ts, cursor=next_cursor)
 
         for message in thread_replies["messages"]:
             if (message["type"] == "message"):
@@ -84,7 +107,53 @@ def get_thread_messages(slack_channel, ts):
             print(next_cursor)
     return s
 
-def get_channel_messages(slack_channels, start_time=None, end_time=None):
+def write_channel_messages(table_writer, slack_channel, oldest=None, latest=None):
+    """
+    Writes all of the messages in the channel to the table writer
+
+    Parameters:
+        table_writer (DynamicTableWriter): The table writer to write the messages to
+        slack_channel (str): The string ID of the slack channel to pull from
+        oldest (str): If given, only retrieve messages after this time stamp, in seconds since the Epoch
+        latest (str): If given, only retrieves messages before this time stamp, in seconds since the Epoch
+    Returns:
+        str: The time stamp of the newest message in the channel, or None if no messages were found
+    """
+    newest_ts = None
+    next_cursor = None
+    while True:
+        SLACK_RATE_LIMITER.wait()
+        channel_history = get_slack_client().conversations_history(channel=slack_channel, cursor=next_cursor, include_all_metadata=True,
+                                                             oldest=oldest, latest=latest)
+
+        for message in channel_history["messages"]:
+            if (message["type"] == "message"):
+                if newest_ts is None or float(message["ts"]) > float(newest_ts):
+                    newest_ts = message["ts"]
+                #If message is in a thread, get the thread messages. "thread_ts" seems to
+                #be the only identifier for a thread being present. And the threading API
+                #expects the ts of the original message too
+                if ("thread_ts" in message):
+                    for (ts, text, json_str) in get_thread_messages(slack_channel, message["ts"]):
+                        table_writer.write_row(slack_channel, ts, text, json_str)
+                #Otherwise just add the message
+                else:
+                    table_writer.write_row(slack_channel, message["ts"], message["text"], json.dumps(message))
+
+        if bool(channel_history["has_more"]):
+            next_cursor = channel_history["response_metadata"]["next_cursor"]
+        else:
+            next_cursor = None
+
+        if next_cursor is None:
+            break
+
+        print("Pagination found, getting next entries")
+        print(next_cursor)
+
+    return newest_ts
+
+def get_channel_messages(slack_channels, start_time=None, end_time=None, spill_path=None):
     """
     Returns all of the messages in the channel
 
@@ -92,6 +161,8 @@ def get_channel_messages(slack_channels, start_time=None, end_time=None):
         slack_channels (list<str>): A list of string IDs representing the slack channels to pull from
         start_time (DateTime): If given, only retrieve messages after this time stamp
         end_time (DateTime): If given, only retrieves messages before this time stamp
+        spill_path (str): If given, messages are spilled to Parquet files in this directory
+            instead of being kept in memory. Should end with /
     Returns
         Table: A Deephaven table of all the messages
     """
@@ -102,53 +173,22 @@ def get_channel_messages(slack_channels, start_time=None, end_time=None):
     if not (end_time is None):
         end_time_seconds = str(end_time.getMillis()/1000)
 
-    dtw_columns = {
-        "ChannelID": dht.string,
-        "TS": dht.string,
-        "Text": dht.string,
-        "JsonString": dht.string,
-    }
-    table_writer = DynamicTableWriter(dtw_columns)
+    table_writer = new_table_writer(SLACK_MESSAGE_COLUMNS, spill_path=spill_path)
 
     for slack_channel in slack_channels:
-        next_cursor = None
-        while True:
-            channel_history = slack_client.conversations_history(channel=slack_channel, cursor=next_cursor, include_all_metadata=True,
-                                                                 oldest=start_time_seconds, latest=end_time_seconds)
-
-            for message in channel_history["messages"]:
-                if (message["type"] == "message"):
-                    #If message is in a thread, get the thread messages. "thread_ts" seems to
-                    #be the only identifier for a thread being present. And the threading API
-                    #expects the ts of the original message too
-                    if ("thread_ts" in message):
-                        for (ts, text, json_str) in get_thread_messages(slack_channel, message["ts"]):
-                            table_writer.write_row(slack_channel, ts, text, json_str)
-                    #Otherwise just add the message
-                    else:
-                        table_writer.write_row(slack_channel, message["ts"], message["text"], json.dumps(message))
-
-            if bool(channel_history["has_more"]):
-                next_cursor = channel_history["response_metadata"]["next_cursor"]
-            else:
-                next_cursor = None
-
-            if next_cursor is None:
-                break
-
-            print("Pagination found, getting next entries")
-            print(next_cursor)
-            time.sleep(1.2)
+        write_channel_messages(table_writer, slack_channel, oldest=start_time_seconds, latest=end_time_seconds)
 
     return table_writer.table
 
-def get_all_slack_messages(start_time=None, end_time=None):
+def get_all_slack_messages(start_time=None, end_time=None, spill_path=None):
     """
     Gets all the messages across all channels.
 
     Parameters:
         start_time (DateTime): If given, only retrieve messages after this time stamp
         end_time (DateTime): If given, only retrieves messages before this time stamp
+        spill_path (str): If given, messages are spilled to Parquet files in this directory
+            instead of being kept in memory. Should end with /
 
     Returns:
         (Table, Table): The table of slack channel information, and the table of slack message information
@@ -167,4 +207,4 @@ def get_all_slack_messages(start_time=None, end_time=None):
         channel_ids.append(channel_id)
         table_writer.write_row(channel_id, channel_name, channel_json)
 
-    return (table_writer.table, get_channel_messages(channel_ids, start_time=start_time, end_time=end_time))
+    return (table_writer.table, get_channel_messages(channel_ids, start_time=start_time, end_time=end_time, spill_path=spill_path))
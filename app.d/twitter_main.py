@@ -6,8 +6,10 @@ Main file to collect data from the Twitter Ads API
 This file does not create any tables or plots in Deephaven. Instead, it defines functions
 to be called in the Deephaven UI.
 """
-from deephaven import DynamicTableWriter
+from deephaven import DynamicTableWriter, merge
 import deephaven.dtypes as dht
+from deephaven.constants import NULL_LONG
+from deephaven.parquet import read, write
 from deephaven.time import plus_period, to_datetime, to_period
 
 from twitter_ads.client import Client
@@ -17,8 +19,8 @@ from twitter_ads.enum import  METRIC_GROUP
 import json
 import os
 from datetime import datetime
-import time
-import copy
+import hashlib
+import threading
 
 TWITTER_CONSUMER_KEY = os.environ.get("TWITTER_CONSUMER_KEY")
 TWITTER_CONSUMER_SECRET = os.environ.get("TWITTER_CONSUMER_SECRET")
@@ -26,14 +28,94 @@ TWITTER_ACCESS_TOKEN = os.environ.get("TWITTER_ACCESS_TOKEN")
 TWITTER_ACCESS_TOKEN_SECRET = os.environ.get("TWITTER_ACCESS_TOKEN_SECRET")
 
 PROMOTED_TWEET_DURATION = to_period("14D")
+TWITTER_METADATA_PATH = "/data/twitter-metadata/"
+METADATA_VERSIONS_FILE = "_VERSIONS.json"
 
-twitter_client = Client(TWITTER_CONSUMER_KEY, TWITTER_CONSUMER_SECRET, TWITTER_ACCESS_TOKEN, TWITTER_ACCESS_TOKEN_SECRET)
+def twitter_time_to_datetime(twitter_time):
+    """
+    Converts a time from the Twitter API to a Deephaven DateTime
+
+    Parameters:
+        twitter_time (str): The time in the yyyy-mm-ddThh:mm:ssZ format
+    Returns:
+        DateTime: The time as a Deephaven DateTime object
+    """
+    return to_datetime(twitter_time[0:-1] + " UTC")
+
+#Metadata fields collected for every entity type, as tuples of the API attribute name,
+#Deephaven table column name, Deephaven type, and the converter to the Deephaven type
+METADATA_COMMON_FIELDS = [
+    ("id", "Id", dht.string, str),
+    ("name", "Name", dht.string, str),
+    ("entity_status", "EntityStatus", dht.string, str),
+    ("created_at", "CreatedAt", dht.DateTime, twitter_time_to_datetime),
+    ("updated_at", "UpdatedAt", dht.DateTime, twitter_time_to_datetime),
+    ("deleted", "Deleted", dht.bool_, bool),
+]
+#Additional metadata fields collected for each entity type, by Deephaven table column name of the entity type
+METADATA_FIELDS = {
+    "Campaign": [
+        ("funding_instrument_id", "FundingInstrumentId", dht.string, str),
+        ("currency", "Currency", dht.string, str),
+        ("daily_budget_amount_local_micro", "DailyBudgetAmountLocalMicro", dht.long, int),
+        ("total_budget_amount_local_micro", "TotalBudgetAmountLocalMicro", dht.long, int),
+        ("start_time", "StartTime", dht.DateTime, twitter_time_to_datetime),
+        ("end_time", "EndTime", dht.DateTime, twitter_time_to_datetime),
+    ],
+    "AdGroup": [
+        ("campaign_id", "CampaignId", dht.string, str),
+        ("objective", "Objective", dht.string, str),
+        ("product_type", "ProductType", dht.string, str),
+        ("bid_amount_local_micro", "BidAmountLocalMicro", dht.long, int),
+        ("total_budget_amount_local_micro", "TotalBudgetAmountLocalMicro", dht.long, int),
+        ("start_time", "StartTime", dht.DateTime, twitter_time_to_datetime),
+        ("end_time", "EndTime", dht.DateTime, twitter_time_to_datetime),
+    ],
+    "FundingInstrument": [
+        ("type", "Type", dht.string, str),
+        ("currency", "Currency", dht.string, str),
+        ("credit_limit_local_micro", "CreditLimitLocalMicro", dht.long, int),
+        ("funded_amount_local_micro", "FundedAmountLocalMicro", dht.long, int),
+        ("start_time", "StartTime", dht.DateTime, twitter_time_to_datetime),
+        ("end_time", "EndTime", dht.DateTime, twitter_time_to_datetime),
+    ],
+    "PromotedTweet": [
+        ("line_item_id", "LineItemId", dht.string, str),
+        ("tweet_id", "TweetId", dht.string, str),
+        ("approval_status", "ApprovalStatus", dht.string, str),
+    ],
+    "MediaCreative": [
+        ("line_item_id", "LineItemId", dht.string, str),
+        ("account_media_id", "AccountMediaId", dht.string, str),
+        ("landing_url", "LandingUrl", dht.string, str),
+        ("approval_status", "ApprovalStatus", dht.string, str),
+    ],
+}
+
+_twitter_client = None
+_twitter_client_lock = threading.Lock()
+
+def get_twitter_client():
+    """
+    Returns the Twitter client shared across collectors. The client is created on first use,
+    so loading this file doesn't depend on the Twitter API.
+
+    Returns:
+        Client: The Twitter client to make API calls
+    """
+    global _twitter_client
+    with _twitter_client_lock:
+        if _twitter_client is None:
+            _twitter_client = Client(TWITTER_CONSUMER_KEY, TWITTER_CONSUMER_SECRET, TWITTER_ACCESS_TOKEN, TWITTER_ACCESS_TOKEN_SECRET)
+        return _twitter_client
 
 class TwitterCollector:
     """
     A class to nicely define what data to collect from Twitter's ads API
 
     Attributes:
+        twitter_client (Client): The Twitter client to make API calls
+        analytics_types (list<tuple>): The analytics types used to build the analytics_items attribute
         analytics_items (list<tuple>): A list of tuples that contains the following:
             API analytics name, Deephaven table column name, twitter account, twitter analytics,
             and the analytics range method
@@ -49,13 +131,25 @@ class TwitterCollector:
             API analytics name, Deephaven table column name, the twitter analytics method to pull from,
             and the analytics range method. This is used to build the analytics_items attribute
         """
-        self.analytics_items = []
-        for account in twitter_client.accounts():
-            for (api_name, table_name, analytics_list_method, out_of_range) in analytics_types:
+        self.twitter_client = twitter_client
+        self.analytics_types = analytics_types
+        self.load_analytics_items()
+
+    def load_analytics_items(self):
+        """
+        Builds the analytics_items attribute from the entities currently in the Twitter accounts
+
+        Returns:
+            None
+        """
+        analytics_items = []
+        for account in self.twitter_client.accounts():
+            for (api_name, table_name, analytics_list_method, out_of_range) in self.analytics_types:
                 for analytics in analytics_list_method(account):
-                    self.analytics_items.append((api_name, table_name, account, analytics, out_of_range))
+                    analytics_items.append((api_name, table_name, account, analytics, out_of_range))
+        self.analytics_items = analytics_items
 
-    def twitter_analytics_data(self, start_date, end_date, date_increment):
+    def twitter_analytics_data(self, start_date, end_date, date_increment, spill_path=None):
         """
         Main method for the twitter ads data collector. Collects data of various types
         and returns a Deephaven Table
@@ -63,6 +157,8 @@ class TwitterCollector:
             start_date (DateTime): The start date as a Deephaven DateTime object.
             end_Date (DateTime): The end date as a Deephaven DateTime object.
             date_increment (Period): The time increment for subsequent data retrievals
+            spill_path (str): If given, collected rows are spilled to Parquet files in this directory
+                instead of being kept in memory. Should end with /
         Returns:
             Table: The Deephaven table containing the data
         """
@@ -73,9 +169,12 @@ class TwitterCollector:
             "AnalyticsType": dht.string,
             "AnalyticsName": dht.string,
             "Placement": dht.string,
+            "Impressions": dht.long,
+            "Clicks": dht.long,
+            "Engagements": dht.long,
             "JsonString": dht.string,
         }
-        table_writer = DynamicTableWriter(dtw_columns)
+        table_writer = new_table_writer(dtw_columns, spill_path=spill_path)
 
         #Loop through dates
         current_date = start_date
@@ -87,36 +186,211 @@ class TwitterCollector:
             for (api_name, table_name, account, analytics, out_of_range) in self.analytics_items:
                 if not out_of_range(analytics, current_date, next_date):
                     for placement in ["PUBLISHER_NETWORK", "ALL_ON_TWITTER"]:
-                        json_str = get_analytics_metrics(account, analytics, current_date, next_date, placement, api_name)
+                        response = get_analytics_response(account, analytics, current_date, next_date, placement, api_name)
+                        totals = engagement_totals(response)
                         name = None
                         if hasattr(analytics, "name"):
                             name = analytics.name
-                        table_writer.write_row(current_date, account.name, table_name, name, placement, json_str)
+                        table_writer.write_row(current_date, account.name, table_name, name, placement,
+                                               totals["impressions"], totals["clicks"], totals["engagements"], json.dumps(response))
 
             current_date = next_date
 
         return table_writer.table
 
-    def twitter_analytics_metadata(self):
+    def twitter_analytics_metadata(self, valid_from, versions):
         """
-        Returns a Deephaven table containing metadata from the analytics items found in the account
+        Returns Deephaven tables containing the metadata of the analytics items whose content changed
+        since the previous run, with one table per entity type. Items that were in the previous versions
+        but are no longer listed get a closing version with Deleted set and every other field null.
+
+        Parameters:
+            valid_from (DateTime): The date the changed metadata is valid from
+            versions (dict<str, dict>): The content hash, valid from date, and previous valid from date
+                of the current version of each analytics item. Returned by the previous run
         Returns:
-            Table: The Deephaven table
+            tuple(dict<str, Table>, dict<str, dict>): The changed metadata tables by Deephaven table column
+                name of the entity type, and the updated versions
         """
-        dtw_columns = {
-            "JsonString": dht.string,
-        }
-        table_writer = DynamicTableWriter(dtw_columns)
+        valid_from_day = valid_from.toDateString()
+        versions = dict(versions)
+        #Tuples of the Deephaven table column name of the entity type, entity ID, projected metadata, and content hash
+        changes = []
+        seen_keys = set()
+
+        for (_, table_name, _, analytics, _) in self.analytics_items:
+            fields = METADATA_COMMON_FIELDS + METADATA_FIELDS.get(table_name, [])
+            #Only the metadata fields are read from the analytics object, which also leaves out the account
+            projection = {}
+            for (attribute, _, _, _) in fields:
+                projection[attribute] = getattr(analytics, f"_{attribute}", None)
+            content_hash = hashlib.sha1(json.dumps(projection, sort_keys=True, default=str).encode()).hexdigest()
+
+            key = f"{table_name}:{analytics.id}"
+            seen_keys.add(key)
+            previous = versions.get(key)
+            if not (previous is None) and previous["hash"] == content_hash:
+                continue
+            changes.append((table_name, analytics.id, projection, content_hash))
+
+        #Entities that are no longer listed (including deleted ones, which the API leaves out) get a closing
+        #version, so their last version gets a ValidTo. Closing versions have a null hash and Deleted set
+        for (key, previous) in versions.items():
+            if key in seen_keys or previous["hash"] is None:
+                continue
+            (table_name, entity_id) = key.split(":", 1)
+            projection = {}
+            for (attribute, _, _, _) in METADATA_COMMON_FIELDS + METADATA_FIELDS.get(table_name, []):
+                projection[attribute] = None
+            projection["id"] = entity_id
+            projection["deleted"] = True
+            changes.append((table_name, entity_id, projection, None))
+
+        table_writers = {}
+        for (table_name, entity_id, projection, content_hash) in changes:
+            key = f"{table_name}:{entity_id}"
+            previous = versions.get(key)
+            previous_valid_from = None
+            if not (previous is None):
+                #A second change on the same day replaces that day's version
+                if previous["valid_from"] == valid_from_day:
+                    previous_valid_from = previous["previous_valid_from"]
+                else:
+                    previous_valid_from = previous["valid_from"]
+            versions[key] = {
+                "hash": content_hash,
+                "valid_from": valid_from_day,
+                "previous_valid_from": previous_valid_from,
+            }
+
+            if not (table_name in table_writers):
+                table_writers[table_name] = DynamicTableWriter(metadata_columns(table_name))
+            row = []
+            for (attribute, _, dh_type, converter) in METADATA_COMMON_FIELDS + METADATA_FIELDS.get(table_name, []):
+                value = projection[attribute]
+                if value is None:
+                    row.append(NULL_LONG if dh_type == dht.long else None)
+                else:
+                    row.append(converter(value))
+            row.append(content_hash)
+            row.append(day_to_datetime(valid_from_day))
+            row.append(None if previous_valid_from is None else day_to_datetime(previous_valid_from))
+            table_writers[table_name].write_row(row)
+
+        tables = {}
+        for (table_name, table_writer) in table_writers.items():
+            tables[table_name] = table_writer.table
+        return (tables, versions)
+
+def metadata_columns(table_name):
+    """
+    Returns the columns of the metadata table of the entity type
 
-        for (_, _, _, analytics, _) in self.analytics_items:
-            #Workaround to clear sensitive items since del and pop are deleting the objects,
-            #not just clearing the key
-            analytics_dict = copy.deepcopy(vars(analytics))
-            analytics_dict["_account"] = None
-            analytics_dict.pop("_account")
-            table_writer.write_row([json.dumps(analytics_dict)])
+    Parameters:
+        table_name (str): The Deephaven table column name of the entity type
+    Returns:
+        dict<str, dht.type>: The Deephaven types by column name
+    """
+    dtw_columns = {}
+    for (_, column_name, dh_type, _) in METADATA_COMMON_FIELDS + METADATA_FIELDS.get(table_name, []):
+        dtw_columns[column_name] = dh_type
+    dtw_columns["Hash"] = dht.string
+    dtw_columns["ValidFrom"] = dht.DateTime
+    dtw_columns["PreviousValidFrom"] = dht.DateTime
+    return dtw_columns
+
+def day_to_datetime(day):
+    """
+    Converts a day to a Deephaven DateTime at the start of the day in UTC
 
-        return table_writer.table
+    Parameters:
+        day (str): The day in the yyyy-mm-dd format
+    Returns:
+        DateTime: The day as a Deephaven DateTime object
+    """
+    return to_datetime(f"{day}T00:00:00 UTC")
+
+def read_metadata_versions(path=None):
+    """
+    Reads the versions of the analytics items written by write_twitter_metadata
+
+    Parameters:
+        path (str): The path of the metadata. Should end with /. Defaults to TWITTER_METADATA_PATH
+    Returns:
+        dict<str, dict>: The versions, or an empty dict if no metadata has been written
+    """
+    if path is None:
+        path = TWITTER_METADATA_PATH
+    if not os.path.exists(f"{path}{METADATA_VERSIONS_FILE}"):
+        return {}
+    with open(f"{path}{METADATA_VERSIONS_FILE}") as f:
+        return json.load(f)
+
+def write_twitter_metadata(tables, versions, valid_from, path=None):
+    """
+    Writes the changed metadata tables returned by TwitterCollector.twitter_analytics_metadata,
+    and then the updated versions. Each entity type gets a directory with one file per day.
+
+    Parameters:
+        tables (dict<str, Table>): The changed metadata tables by Deephaven table column name of the entity type
+        versions (dict<str, dict>): The updated versions
+        valid_from (DateTime): The date the changed metadata is valid from
+        path (str): The path to write to. Should end with /. Defaults to TWITTER_METADATA_PATH
+    Returns:
+        None
+    """
+    if path is None:
+        path = TWITTER_METADATA_PATH
+    for (table_name, table) in tables.items():
+        file_path = f"{path}{table_name}/{valid_from.toDateString()}.parquet"
+        #Keep the versions written earlier on the same day that didn't change again
+        if os.path.exists(file_path):
+            table = merge([table, read(file_path).where_not_in(table, ["Id"])])
+            write(table, f"{file_path}.tmp")
+            os.replace(f"{file_path}.tmp", file_path)
+        else:
+            write(table, file_path)
+
+    #The versions are replaced in one step, so a crash while writing can't leave a truncated file
+    os.makedirs(path, exist_ok=True)
+    with open(f"{path}{METADATA_VERSIONS_FILE}.tmp", "w") as f:
+        json.dump(versions, f)
+    os.replace(f"{path}{METADATA_VERSIONS_FILE}.tmp", f"{path}{METADATA_VERSIONS_FILE}")
+
+def read_twitter_metadata(path=None):
+    """
+    Reads the metadata written by write_twitter_metadata. A ValidTo column is added from the
+    ValidFrom date of the next version, and is null for the current version.
+
+    Parameters:
+        path (str): The path of the metadata. Should end with /. Defaults to TWITTER_METADATA_PATH
+    Returns:
+        tuple(dict<str, Table>, Table): The metadata tables by Deephaven table column name of the entity type,
+            and a table of the common columns across all of the entity types
+    """
+    if path is None:
+        path = TWITTER_METADATA_PATH
+    common_columns = [column_name for (_, column_name, _, _) in METADATA_COMMON_FIELDS] + ["ValidFrom", "ValidTo"]
+
+    tables = {}
+    common_tables = []
+    for table_name in METADATA_FIELDS.keys():
+        table_path = f"{path}{table_name}/"
+        if not os.path.isdir(table_path):
+            continue
+        versions = merge([read(f"{table_path}{file_name}") for file_name in sorted(os.listdir(table_path)) if file_name.endswith(".parquet")])
+        tables[table_name] = versions.natural_join(versions.view(["Id", "PreviousValidFrom", "ValidTo = ValidFrom"]),
+                                                   on=["Id", "ValidFrom = PreviousValidFrom"], joins=["ValidTo"])
+        common_tables.append(tables[table_name].view([f"EntityType = `{table_name}`"] + common_columns))
+
+    if len(common_tables) == 0:
+        dtw_columns = {"EntityType": dht.string}
+        for (_, column_name, dh_type, _) in METADATA_COMMON_FIELDS:
+            dtw_columns[column_name] = dh_type
+        dtw_columns["ValidFrom"] = dht.DateTime
+        dtw_columns["ValidTo"] = dht.DateTime
+        return (tables, DynamicTableWriter(dtw_columns).table)
+    return (tables, merge(common_tables))
 
 def promoted_tweet_out_of_range(promoted_tweet, start_date, end_date):
     """
@@ -163,9 +437,9 @@ def analytics_out_of_range(analytics, start_date, end_date):
     #Otherwise the analytics is in range
     return (start_date >= analytics_start_time and start_date >= analytics_end_time) or (end_date <= analytics_start_time and end_date <= analytics_end_time)
 
-def get_analytics_metrics(account, analytics, start_date, end_date, placement, entity):
+def get_analytics_response(account, analytics, start_date, end_date, placement, entity):
     """
-    Gets the analytics metrics for the given analytics item for the given date range
+    Gets the analytics response for the given analytics item for the given date range
 
     Parameters:
         account (Account): The Twitter account object
@@ -175,7 +449,7 @@ def get_analytics_metrics(account, analytics, start_date, end_date, placement, e
         placement (str): The Twitter placement. Should be one of "ALL_ON_TWITTER" or "PUBLISHER_NETWORK"
         entity (str): The entity of the analytics object for the API request. Should be "CAMPAIGN" or "LINE_ITEM"
     Returns:
-        str: A JSON string of the analyitcs response
+        list<dict>: The analytics response
     """
     metric_groups = [METRIC_GROUP.ENGAGEMENT]
     kwargs = {
@@ -185,10 +459,49 @@ def get_analytics_metrics(account, analytics, start_date, end_date, placement, e
         "granularity": "HOUR",
         "placement": placement
     }
+    TWITTER_RATE_LIMITER.wait()
     response = Analytics.all_stats(account, [analytics.id], metric_groups, **kwargs)
-    time.sleep(4)
 
-    return json.dumps(response)
+    return response
+
+def get_analytics_metrics(account, analytics, start_date, end_date, placement, entity):
+    """
+    Gets the analytics metrics for the given analytics item for the given date range
+
+    Parameters:
+        account (Account): The Twitter account object
+        analytics (Analytics): The Twitter analytics object
+        start_date (DateTime): The start date as a Deephaven DateTime object
+        end_date (DateTime): The end date as a Deephaven DateTime object
+        placement (str): The Twitter placement. Should be one of "ALL_ON_TWITTER" or "PUBLISHER_NETWORK"
+        entity (str): The entity of the analytics object for the API request. Should be "CAMPAIGN" or "LINE_ITEM"
+    Returns:
+        str: A JSON string of the analyitcs response
+    """
+    return json.dumps(get_analytics_response(account, analytics, start_date, end_date, placement, entity))
+
+def engagement_totals(response):
+    """
+    Sums the hourly engagement metrics of an analytics response
+
+    Parameters:
+        response (list<dict>): The analytics response
+    Returns:
+        dict<str, int>: The total impressions, clicks, and engagements
+    """
+    totals = {
+        "impressions": 0,
+        "clicks": 0,
+        "engagements": 0,
+    }
+    for item in response:
+        for id_data in item["id_data"]:
+            for metric in totals.keys():
+                #Metrics without any activity are null instead of a list of zeros
+                hourly_values = id_data["metrics"].get(metric)
+                if not (hourly_values is None):
+                    totals[metric] += sum(hourly_values)
+    return totals
 
 def get_campaigns(account):
     """
@@ -201,9 +514,9 @@ def get_campaigns(account):
         list<Campaign>: The list of all campaigns across the account
     """
     campaigns = []
+    TWITTER_RATE_LIMITER.wait()
     for campaign in account.campaigns():
         campaigns.append(campaign)
-    time.sleep(4)
     return campaigns
 
 def get_line_items(account):
@@ -217,9 +530,9 @@ def get_line_items(account):
         list<LineItem>: The list of all line items across the account
     """
     line_items = []
+    TWITTER_RATE_LIMITER.wait()
     for line_item in account.line_items():
         line_items.append(line_item)
-    time.sleep(4)
     return line_items
 
 def get_funding_instruments(account):
@@ -233,9 +546,9 @@ def get_funding_instruments(account):
         list<FundingInstrument>: The list of all funding instruments across the account
     """
     funding_instruments = []
+    TWITTER_RATE_LIMITER.wait()
     for funding_instrument in account.funding_instruments():
         funding_instruments.append(funding_instrument)
-    time.sleep(4)
     return funding_instruments
 
 def get_promoted_tweets(account):
@@ -249,9 +562,9 @@ def get_promoted_tweets(account):
         list<PromotedTweet>: The list of all promoted tweets across the account
     """
     promoted_tweets = []
+    TWITTER_RATE_LIMITER.wait()
     for promoted_tweet in account.promoted_tweets():
         promoted_tweets.append(promoted_tweet)
-    time.sleep(4)
     return promoted_tweets
 
 def get_media_creatives(account):
@@ -265,7 +578,7 @@ def get_media_creatives(account):
         list<MediaCreative>: The list of all media creatives across the account
     """
     media_creatives = []
+    TWITTER_RATE_LIMITER.wait()
     for media_creative in account.media_creatives():
         media_creatives.append(media_creative)
-    time.sleep(4)
     return media_creatives
@@ -1,28 +1,161 @@
 """
-This script normalizes the Twitter Placement and Google query params into a single table
+This script normalizes the Twitter Placement and Google query params into a single table, and keeps
+daily, weekly and monthly rollups of them in Parquet under /data/rollups/
+
+The rollups are updated incrementally. Only the days that haven't been rolled up yet are aggregated,
+and the result is written as a new delta file for each rollup. Reading a rollup re-sums its delta files,
+which are already aggregated and much smaller than the source tables. Rows added to a day after it has
+been rolled up are not picked up.
 """
-from deephaven import Aggregation as agg, as_list
+from deephaven import agg, merge, new_table
+from deephaven.column import string_col
+from deephaven.parquet import read, write
+from deephaven.pandas import to_pandas
 
-#Google
-def clean_query_params(strn):
-    if "query_params" in strn:
-        return strn[0:-12]
-    else:
-        return strn
+import os
 
-google_table_summed = google_table.update("URL = clean_query_params(URL)")
+ROLLUP_PATH = "/data/rollups/"
+DAYS_FILE = "_DAYS"
+COMPACTING_FILE = "_COMPACTING"
+COMPACTED_PREFIX = "compacted-" #Prefix of compacted files, so a delta file (named <day>.parquet) never overwrites one
+COMPACT_AFTER = 30 #Number of delta files a rollup can have before they are compacted into one
 
-agg_list = as_list([
-    agg.AggSum("PageViews")
-])
+#Rollup name, the period column, and the formula to create the period column from Date
+ROLLUPS = [
+    ("daily", "Date", None),
+    ("weekly", "Week", "Week = lowerBin(Date, WEEK, 4 * DAY)"), #Weeks start on Monday
+    ("monthly", "Month", "Month = Date.toDateString().substring(0, 7)"),
+]
 
-google_table_summed = google_table_summed.aggBy(agg_list, "Date", "URL")
+def rolled_up_days(path):
+    """
+    Returns the days that have already been rolled up
 
-#Twitter
-agg_list = as_list([
-    agg.AggSum("Clicks"),
-    agg.AggSum("Engagements"),
-    agg.AggSum("Impressions")
-])
+    Parameters:
+        path (str): The path of the rollups. Should end with /
+    Returns:
+        set<str>: The yyyy-mm-dd days that have been rolled up
+    """
+    if not os.path.exists(f"{path}{DAYS_FILE}"):
+        return set()
+    with open(f"{path}{DAYS_FILE}") as f:
+        return set(f.read().split())
+
+def finish_compaction(path):
+    """
+    Finishes or discards a compaction of the rollup's delta files that was interrupted
+
+    A compaction writes the compacted rollup to <compacted file>.compacted, lists the compacted file and the
+    delta files it replaces in the COMPACTING_FILE, moves the compacted file into place, and then removes the
+    replaced delta files and the COMPACTING_FILE. Until the COMPACTING_FILE is written the delta files are
+    untouched, so the compacted file is discarded. After that the compaction can always be finished.
+
+    Compacted files are named compacted-<last day>.parquet, so they can't be overwritten by a delta file.
+    Compaction also only happens after the days of the update are recorded in the DAYS_FILE, so if an update
+    fails before then, its rerun rewrites delta files that haven't been compacted yet instead of adding
+    days that are already in a compacted file.
+
+    Parameters:
+        path (str): The path of the rollup. Should end with /
+    Returns:
+        None
+    """
+    if not os.path.exists(f"{path}{COMPACTING_FILE}"):
+        for file_name in os.listdir(path):
+            if file_name.endswith(".compacted"):
+                os.remove(f"{path}{file_name}")
+        return
+
+    with open(f"{path}{COMPACTING_FILE}") as f:
+        [compacted_file, *delta_files] = f.read().split()
+    if os.path.exists(f"{compacted_file}.compacted"):
+        os.replace(f"{compacted_file}.compacted", compacted_file)
+    for delta_file in delta_files:
+        if delta_file != compacted_file and os.path.exists(delta_file):
+            os.remove(delta_file)
+    os.remove(f"{path}{COMPACTING_FILE}")
+
+def read_rollup(path, table, sum_columns, by):
+    """
+    Reads a rollup by re-summing its delta files. Once there are more than COMPACT_AFTER delta files,
+    they are replaced with a single file.
+
+    Parameters:
+        path (str): The path of the rollup. Should end with /
+        table (Table): The empty aggregation to return if the rollup has no delta files
+        sum_columns (list<str>): The columns to sum
+        by (list<str>): The columns to group by
+    Returns:
+        Table: The rollup table
+    """
+    delta_files = []
+    if os.path.exists(path):
+        finish_compaction(path)
+        delta_files = sorted(f"{path}{file_name}" for file_name in os.listdir(path) if file_name.endswith(".parquet"))
+    if len(delta_files) == 0:
+        return table
+
+    rollup = merge([read(delta_file) for delta_file in delta_files]).agg_by([agg.sum_(sum_columns)], by=by)
+    if len(delta_files) > COMPACT_AFTER:
+        last_day = max(os.path.basename(delta_file)[:-len(".parquet")].replace(COMPACTED_PREFIX, "") for delta_file in delta_files)
+        compacted_file = f"{path}{COMPACTED_PREFIX}{last_day}.parquet"
+        write(rollup, f"{compacted_file}.compacted")
+        with open(f"{path}{COMPACTING_FILE}.tmp", "w") as f:
+            f.write("\n".join([compacted_file] + delta_files) + "\n")
+        os.replace(f"{path}{COMPACTING_FILE}.tmp", f"{path}{COMPACTING_FILE}")
+        finish_compaction(path)
+        rollup = read(compacted_file)
+    return rollup
 
-twitter_table_summed = twitter_table.aggBy(agg_list, "Date", "CampaignName", "CampaignId")
+def update_rollups(name, table, sum_columns, keys):
+    """
+    Rolls up the days of the table that haven't been rolled up yet, and returns every rollup of the table
+
+    Parameters:
+        name (str): The name of the rollups, used as their directory
+        table (Table): The table to roll up. Must have a Date column
+        sum_columns (list<str>): The columns to sum
+        keys (list<str>): The columns to group by, in addition to the period column
+    Returns:
+        dict<str, Table>: The rollup tables by rollup name
+    """
+    path = f"{ROLLUP_PATH}{name}/"
+    table = table.update("Day = Date.toDateString()")
+
+    done_days = rolled_up_days(path)
+    new_days = [day for day in to_pandas(table.select_distinct("Day"))["Day"] if not (day in done_days)]
+    new_rows = table.where_in(new_table([string_col("Day", new_days)]), ["Day"])
+
+    empty_rollups = {}
+    for (rollup_name, period_column, period_formula) in ROLLUPS:
+        rollup_rows = new_rows if period_formula is None else new_rows.update(period_formula)
+        delta = rollup_rows.agg_by([agg.sum_(sum_columns)], by=[period_column] + keys)
+        if len(new_days) > 0:
+            write(delta, f"{path}{rollup_name}/{max(new_days)}.parquet")
+        empty_rollups[rollup_name] = delta.head(0)
+
+    #Days are only recorded once every rollup is written, so an interrupted update is redone. Rollups are
+    #only read (and possibly compacted) after this, so a redone update never touches compacted days
+    if len(new_days) > 0:
+        os.makedirs(path, exist_ok=True)
+        with open(f"{path}{DAYS_FILE}", "a") as f:
+            f.write("\n".join(new_days) + "\n")
+
+    rollups = {}
+    for (rollup_name, period_column, _) in ROLLUPS:
+        rollups[rollup_name] = read_rollup(f"{path}{rollup_name}/", empty_rollups[rollup_name], sum_columns, [period_column] + keys)
+    return rollups
+
+#Google
+google_table_cleaned = google_table.update("URL = URL.contains(`query_params`) ? URL.substring(0, URL.length() - 12) : URL")
+
+google_rollups = update_rollups("google", google_table_cleaned, ["PageViews"], ["URL"])
+google_table_summed = google_rollups["daily"]
+google_table_weekly = google_rollups["weekly"]
+google_table_monthly = google_rollups["monthly"]
+
+#Twitter
+twitter_rollups = update_rollups("twitter", twitter_table, ["Clicks", "Engagements", "Impressions"], ["CampaignName", "CampaignId"])
+twitter_table_summed = twitter_rollups["daily"]
+twitter_table_weekly = twitter_rollups["weekly"]
+twitter_table_monthly = twitter_rollups["monthly"]